@@ -21,136 +21,179 @@ PPS/H-Bus monitoring program
 
 import argparse
 import os
-from itertools import count
-import RPi.GPIO as GPIO
-from serial import Serial
-from struct import unpack
+from itertools import repeat
+from operator import itemgetter
+from select import select
+from serial import Serial, SerialException
 import sys
-from time import time
+from time import monotonic_ns, time
 
 BAUD = 4800
 
+# Maximum number of bytes to obtain with a single read from the port
+READ_SIZE = 64
+
 # Netdata update interval. This is the time actually taken to refresh an
 # entire record
 update_every = 20
 
+def read_port(fd, n):
+    """Return up to n bytes available on the serial port's file descriptor.
+    Return no bytes if the port has no data after a spurious wakeup"""
+    try:
+        b = os.read(fd, n)
+    except BlockingIOError:
+        # The port is non-blocking; pyserial also ignores EAGAIN here
+        return b''
+    if not b:
+        raise SerialException(
+            'device reports readiness to read but returned no data')
+    return b
+
+def set_latency_timer(port, latency):
+    """Set the latency timer (in ms) of a USB serial adapter port.
+    Ports that are not USB serial adapters are silently skipped"""
+    tty = os.path.basename(os.path.realpath(port))
+    path = '/sys/bus/usb-serial/devices/%s/latency_timer' % tty
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, 'w') as f:
+            f.write('%d\n' % latency)
+    except OSError as e:
+        sys.stderr.write("Unable to set %s latency timer: %s\n" % (tty, e))
+
 def get_raw_telegram(ser):
     """Receive a telegram sequence, terminated by more than one char time"""
-    t = []
-    while True:
-        b = ser.read()
-        if b:
-            v = unpack('B', b)[0]
-            t.append(v)
-            if t == [0x17]:
-                return t
-        else:
-            if t:
-                return t
+    fd = ser.fileno()
+    timeout = ser.timeout
+    # Wait for the first byte; a lone 0x17 is returned on its own
+    t = bytearray()
+    while not t:
+        select((fd,), (), ())
+        t += read_port(fd, 1)
+    if t == b'\x17':
+        return t
+    # Read whatever has arrived in bulk, until the line goes idle
+    while select((fd,), (), (), timeout)[0]:
+        t += read_port(fd, READ_SIZE)
+    return t
 
 def crc(t):
     """Calculate a telegram's CRC"""
-    sum = 0
-    for v in t:
-        sum += v
-    sum &= 0xff
-    return 0xff - sum + 1
+    return -sum(t) & 0xff
 
 def get_telegram(ser):
     """ Return a full verified telegram"""
     while True:
         t = get_raw_telegram(ser)
         if len(t) == 9:
-            if crc(t[:-1]) == t[-1]:
-                return t[:-1]
+            # Including the CRC byte in the sum yields zero; check it
+            # and remove it in place to avoid copying the telegram
+            if crc(t) == 0:
+                del t[-1]
+                return t
             else:
                 sys.stderr.write("CRC error in received telegram\n")
         elif len(t) != 1:
                 sys.stderr.write("Invalid telegram length %d\n" % len(t))
 
-def get_temp(t):
-    """Return the temperature associated with a telegram as a string"""
-    return '%.1f' % (((t[6] << 8) + t[7]) / 64.)
-
 def get_raw_temp(t):
     """Return the temperature associated with a telegram as an integer
     multiplied by 64"""
     return ((t[6] << 8) + t[7])
 
+def decode_raw_temp(raw):
+    """Return the formatted and raw value of a raw temperature"""
+    return ('%.1f' % (raw / 64.), raw)
+
+def decode_temp(t):
+    """Return a telegram's temperature formatted and raw value"""
+    return decode_raw_temp(get_raw_temp(t))
+
+def get_temp(t):
+    """Return the temperature associated with a telegram as a string"""
+    return decode_temp(t)[0]
+
 def format_telegram(t):
     """Format the passed telegram"""
-    r = ''
-    for v in t:
-        r += '%02x ' % v
-    r += '(T=%s)' % get_temp(t)
-    return r
-
-def valid_temp(t):
-    """Return true if the telegram's temperature is valid"""
-    return not (t[6] == 0x80 and t[7] == 0x01)
+    return t.hex(' ') + ' (T=%s)' % get_temp(t)
+
+# Raw temperature value reporting an invalid temperature
+INVALID_TEMP = 0x8001
+
+def decode_valid_temp(t):
+    """Return a telegram's temperature formatted and raw value,
+    or None if the temperature is invalid"""
+    raw = get_raw_temp(t)
+    if raw == INVALID_TEMP:
+        return None
+    return decode_raw_temp(raw)
+
+ROOM_UNIT_MODE = {0: 'timed', 1: 'manual', 2: 'off'}
+
+# Map from a telegram's type (its second byte) to the corresponding
+# message and a function returning the telegram's formatted and raw value
+TELEGRAM_DECODER = {
+    0x08: ('Set present room temp', decode_temp),
+    0x09: ('Set absent room temp', decode_temp),
+    0x0b: ('Set DHW temp', decode_temp),
+    0x19: ('Set room temp', decode_temp),
+    0x28: ('Actual room temp', decode_temp),
+    0x29: ('Outside temp', decode_temp),
+    0x2b: ('Actual DHW temp', decode_temp),
+    0x2c: ('Actual flow temp', decode_valid_temp),
+    0x2e: ('Actual boiler temp', decode_valid_temp),
+    0x48: ('Authority',
+           lambda t: (('remote' if t[7] == 0 else 'controller'), t[7])),
+    0x49: ('Mode', lambda t: (ROOM_UNIT_MODE.get(t[7], 'unknown'), t[7])),
+    0x4c: ('Present', lambda t: (('true' if t[7] else 'false'), t[7])),
+    0x7c: ('Remaining absence days', lambda t: (str(t[7]), t[7])),
+}
+
+# Messages that are output individually, but not included in CSV and
+# netdata records
+UNRECORDED_MESSAGES = {'Remaining absence days'}
 
 def decode_telegram(t):
     """Decode the passed telegram into a message and its formatted and
     raw value.
     The values are None if the telegram is unknown"""
 
-    room_unit_mode = ['timed', 'manual', 'off']
-
-    if t[1] == 0x08:
-        return ('Set present room temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x09:
-        return ('Set absent room temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x0b:
-        return ('Set DHW temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x19:
-        return ('Set room temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x28:
-        return ('Actual room temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x29:
-        return ('Outside temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x2c and  valid_temp(t):
-        return ('Actual flow temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x2b:
-        return ('Actual DHW temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x2e and  valid_temp(t):
-        return ('Actual boiler temp', get_temp(t), get_raw_temp(t))
-    elif t[1] == 0x48:
-        return ('Authority', ('remote' if t[7] == 0 else 'controller'), t[7])
-    elif t[1] == 0x49:
-        return ('Mode', room_unit_mode[t[7]], t[7])
-    elif t[1] == 0x4c:
-        return ('Present', ('true' if t[7] else 'false'), t[7])
-    elif t[1] == 0x7c:
-        return ('Remaining absence days', t[7], t[7])
-    else:
-        return (None, None, None)
+    decoder = TELEGRAM_DECODER.get(t[1])
+    if decoder:
+        (message, decode) = decoder
+        values = decode(t)
+        if values:
+            return (message,) + values
+    return (None, None, None)
+
+# Map from a telegram's peer (its first byte) to the peer's name
+PEER_NAME = {
+    0xfd: 'Room unit:',
+    0x1d: 'Controller:',
+}
+
+# The name of each possible peer and whether it is known, indexed by
+# the telegram's first byte
+PEER = tuple((PEER_NAME[val], True) if val in PEER_NAME
+             else ('0x%02x:' % val, False) for val in range(256))
 
 def decode_peer(t):
     """ Return the peer by its name, and True if the peer is known"""
-    val = t[0]
-    if val == 0xfd:
-        return ('Room unit:', True)
-    elif val == 0x1d:
-        return ('Controller:', True)
-    else:
-        return ('0x%02x:' % val, False)
-
-def print_csv(out, d):
-    """Output the elements of the passed CSV record in a consistent order"""
-    out.write(str(int(time())))
-    for key in sorted(d):
-        out.write(',' + d[key])
-    out.write("\n")
-
-def print_csv_header(out, d):
-    """Output the header of the passed CSV record in a consistent order"""
-    out.write('time')
-    for key in sorted(d):
-        out.write(',' + key)
-    out.write("\n")
+    return PEER[t[0]]
+
+def print_csv(out, d, get_values):
+    """Output the elements of the passed CSV record, as returned in a
+    consistent order by the passed function"""
+    out.write('%d,%s\n' % (time(), ','.join(get_values(d))))
+
+def print_csv_header(out, keys):
+    """Output the header of a CSV record with the specified keys"""
+    out.write('time,%s\n' % ','.join(keys))
 
 def monitor(port, nmessage, show_unknown, show_raw, out, csv_output,
-            header_output, netdata_output):
+            header_output, netdata_output, latency):
     """Monitor PPS traffic"""
     global update_every
 
@@ -161,96 +204,117 @@ def monitor(port, nmessage, show_unknown, show_raw, out, csv_output,
     TIMEOUT = 1. / CPS * 10
 
 
+    # Imported here, so that the decoding functions can be used off the Pi
+    import RPi.GPIO as GPIO
+
     # Setup 3.3V on pin 12, as required by the circuit board
     GPIO.setmode(GPIO.BOARD)
     GPIO.setup(12, GPIO.OUT, initial=GPIO.HIGH)
 
     with Serial(port, BAUD, timeout=TIMEOUT) as ser:
+        set_latency_timer(port, latency)
         csv_record = {}
+        csv_keys = ()
+        csv_key_set = frozenset()
+        csv_values = None
         raw_record = {}
-        last_run = dt_since_last_run = 0
-        for i in range(int(nmessage)) if nmessage else count():
+        last_run = None
+        dt_since_last_run = 0
+        update_every_ns = update_every * 1000000000
+        for _ in range(int(nmessage)) if nmessage else repeat(None):
             t = get_telegram(ser)
             known = True
             (message, value, raw) = decode_telegram(t)
-            if not value:
+            if value is None:
                 known = False
             (peer, known_peer) = decode_peer(t)
             if not known_peer:
                 known = False
             if known:
+                recorded = message not in UNRECORDED_MESSAGES
                 if csv_output:
-                    csv_record[message] = value
-                    raw_record[message] = raw
+                    if recorded:
+                        csv_record[message] = value
+                        raw_record[message] = raw
                     if len(csv_record) == CSV_ELEMENTS:
+                        # Sort the keys only when the record's fields change
+                        if csv_record.keys() != csv_key_set:
+                            csv_keys = tuple(sorted(csv_record))
+                            csv_key_set = frozenset(csv_keys)
+                            csv_values = itemgetter(*csv_keys)
                         if header_output:
-                            print_csv_header(out, csv_record)
+                            print_csv_header(out, csv_keys)
                             header_output = False
-                        print_csv(out, csv_record)
+                        print_csv(out, csv_record, csv_values)
                         csv_record = {}
                 else:
-                    out.write("%-11s %s: %s\n" % (peer, message, value))
+                    line = "%-11s %s: %s\n" % (peer, message, value)
                     if show_raw:
-                        out.write("%-11s %s\n" % (peer, format_telegram(t)))
-                if netdata_output:
+                        line += "%-11s %s\n" % (peer, format_telegram(t))
+                    out.write(line)
+                if netdata_output and recorded:
                     raw_record[message] = raw
                     # Gather telegrams until update_every has lapsed
                     # https://github.com/firehol/netdata/wiki/External-Plugins
-                    now = time()
-                    if last_run > 0:
-                        dt_since_last_run = now - last_run
-                    if len(raw_record) == CSV_ELEMENTS and (last_run == 0 or
-                            dt_since_last_run >= update_every):
-                        netdata_set_values(raw_record, dt_since_last_run)
-                        raw_record = {}
-                        last_run = now
+                    if len(raw_record) == CSV_ELEMENTS:
+                        now = monotonic_ns()
+                        if last_run is not None:
+                            dt_since_last_run = now - last_run
+                        if (last_run is None or
+                                dt_since_last_run >= update_every_ns):
+                            netdata_set_values(raw_record,
+                                               dt_since_last_run // 1000)
+                            raw_record = {}
+                            last_run = now
             elif show_unknown:
                 out.write("%-11s %s\n" % (peer, format_telegram(t)))
     GPIO.cleanup()
 
 def netdata_set_values(r, dt):
-    """Output the values of a completed record"""
-
-    # Express dt in integer microseconds
-    dt = int(dt * 1e6)
-
-    print('BEGIN Heating.ambient %d' % dt)
-    print('SET t_room_set = %d' % r['Set room temp'])
-    print('SET t_room_actual = %d' % r['Actual room temp'])
-    print('SET t_outside = %d' % r['Outside temp'])
-    print('END')
-
-    print('BEGIN Heating.dhw %d' % dt)
-    print('SET t_dhw_set = %d' % r['Set DHW temp'])
-    print('SET t_dhw_actual = %d' % r['Actual DHW temp'])
-    print('END')
+    """Output the values of a completed record; dt is the number of
+    microseconds since the previous output"""
+
+    s = ('BEGIN Heating.ambient %d\n'
+         'SET t_room_set = %d\n'
+         'SET t_room_actual = %d\n'
+         'SET t_outside = %d\n'
+         'END\n'
+         'BEGIN Heating.dhw %d\n'
+         'SET t_dhw_set = %d\n'
+         'SET t_dhw_actual = %d\n'
+         'END\n') % (dt, r['Set room temp'], r['Actual room temp'],
+                     r['Outside temp'],
+                     dt, r['Set DHW temp'], r['Actual DHW temp'])
 
     if 'Actual flow temp' in r:
-        print('BEGIN Heating.flow %d' % dt)
-        print('SET t_heating = %d' % r['Actual flow temp'])
-        print('END')
+        s += ('BEGIN Heating.flow %d\n'
+              'SET t_heating = %d\n'
+              'END\n') % (dt, r['Actual flow temp'])
 
     if 'Actual boiler temp' in r:
-        print('BEGIN Heating.boiler %d' % dt)
-        print('SET t_boiler = %d' % r['Actual boiler temp'])
-        print('END')
-
-    print('BEGIN Heating.set_point %d' % dt)
-    print('SET t_present = %d' % r['Set present room temp'])
-    print('SET t_absent = %d' % r['Set absent room temp'])
-    print('END')
-
-    print('BEGIN Heating.present %d' % dt)
-    print('SET present = %d' % r['Present'])
-    print('END')
-
-    print('BEGIN Heating.mode %d' % dt)
-    print('SET mode = %d' % r['Mode'])
-    print('END')
-
-    print('BEGIN Heating.authority %d' % dt)
-    print('SET authority = %d' % r['Authority'])
-    print('END')
+        s += ('BEGIN Heating.boiler %d\n'
+              'SET t_boiler = %d\n'
+              'END\n') % (dt, r['Actual boiler temp'])
+
+    s += ('BEGIN Heating.set_point %d\n'
+          'SET t_present = %d\n'
+          'SET t_absent = %d\n'
+          'END\n'
+          'BEGIN Heating.present %d\n'
+          'SET present = %d\n'
+          'END\n'
+          'BEGIN Heating.mode %d\n'
+          'SET mode = %d\n'
+          'END\n'
+          'BEGIN Heating.authority %d\n'
+          'SET authority = %d\n'
+          'END\n') % (dt, r['Set present room temp'],
+                       r['Set absent room temp'],
+                       dt, r['Present'],
+                       dt, r['Mode'],
+                       dt, r['Authority'])
+
+    sys.stdout.write(s)
     sys.stdout.flush()
 
 def netdata_configure():
@@ -303,6 +367,10 @@ def main():
     parser.add_argument('-H', '--header',
                         help='Print CSV header',
                         action='store_true')
+    parser.add_argument('-l', '--latency-ms',
+                        help='USB serial adapter latency timer in ms '
+                        '(default: 1)',
+                        type=int, default=1)
     parser.add_argument('-n', '--nmessage',
                         help='Number of messages to process (default: infinite)')
     parser.add_argument('-N', '--netdata',
@@ -328,7 +396,7 @@ def main():
     if args.netdata:
         netdata_configure()
     monitor(args.port, args.nmessage, args.unknown, args.raw, out, args.csv,
-            args.header, args.netdata)
+            args.header, args.netdata, args.latency_ms)
 
 if __name__ == "__main__":
     main()